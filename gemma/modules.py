@@ -59,6 +59,31 @@ def _create_sliding_mask(
   return sliding_mask
 
 
+def _create_ring_buffer_mask(
+    attn_mask: jnp.ndarray,
+    end_index: int,
+    cache_len: int,
+) -> jnp.ndarray:
+  """Maps an attention mask to a smaller ring buffer cache.
+
+  The token at index `i` is kept in slot `i % cache_len` of the ring buffer,
+  and in column `i % attn_mask.shape[-1]` of the attention mask.
+
+  Args:
+    attn_mask: Attention mask over the larger cache `[B, seq_len, L']`.
+    end_index: Number of tokens in the cache before the current ones.
+    cache_len: Length of the ring buffer cache.
+
+  Returns:
+    The attention mask over the ring buffer cache `[B, seq_len, cache_len]`.
+  """
+  last_index = end_index + attn_mask.shape[1] - 1
+  # Index of the (latest) token kept in each slot, negative if none yet.
+  token_index = last_index - (last_index - jnp.arange(cache_len)) % cache_len
+  ring_mask = jnp.take(attn_mask, token_index % attn_mask.shape[-1], axis=-1)
+  return jnp.logical_and(ring_mask, token_index >= 0)
+
+
 class AttentionType(enum.Enum):
   GLOBAL = 1
   LOCAL_SLIDING = 2
@@ -182,15 +207,24 @@ class Attention(nn.Module):
     # Save the KV values to the cache.
     if cache is not None:
       end_index = cache['end_index'][0]
-      slice_indices = (0, end_index % cache['v'].shape[1], 0, 0)
-      value_proj = jax.lax.dynamic_update_slice(
-          cache['v'],
-          value_proj,
-          slice_indices,
-      )
-      key_proj = jax.lax.dynamic_update_slice(
-          cache['k'], key_proj, slice_indices
-      )
+      cache_len = cache['v'].shape[1]
+      if cache_len != attn_mask.shape[-1]:
+        # The layer cache is a ring buffer smaller than the attention mask
+        # (e.g. only the sliding window), so the tokens may wrap around it.
+        attn_mask = _create_ring_buffer_mask(attn_mask, end_index, cache_len)
+        slots = (end_index + jnp.arange(seq_len)) % cache_len
+        value_proj = cache['v'].at[:, slots].set(value_proj)
+        key_proj = cache['k'].at[:, slots].set(key_proj)
+      else:
+        slice_indices = (0, end_index % cache_len, 0, 0)
+        value_proj = jax.lax.dynamic_update_slice(
+            cache['v'],
+            value_proj,
+            slice_indices,
+        )
+        key_proj = jax.lax.dynamic_update_slice(
+            cache['k'], key_proj, slice_indices
+        )
 
     if self.use_gqa:
       # Reshape matrices to enable einsums over groups.
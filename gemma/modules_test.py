@@ -153,6 +153,36 @@ class SlidingWindowTest(absltest.TestCase):
     )
 
 
+  def test_create_ring_buffer_mask(self):
+    # Tokens 0 to 5 over a cache of 8, the last 2 (4 and 5) being processed.
+    attn_mask = jnp.array([[
+        [True, False, True, True, True, False, False, False],
+        [True, False, True, True, True, True, False, False],
+    ]])
+
+    ring_mask = modules._create_ring_buffer_mask(
+        attn_mask, end_index=4, cache_len=4
+    )
+    np.testing.assert_array_equal(
+        ring_mask,
+        # token_index = [
+        #   4,      5,     2,     3,
+        # ]
+        [[[True, False, True, True],
+          [True, True, True, True],]],
+    )
+
+    ring_mask = modules._create_ring_buffer_mask(
+        attn_mask[:, :1], end_index=0, cache_len=4
+    )
+    np.testing.assert_array_equal(
+        ring_mask,
+        # token_index = [
+        #   0,     -3,    -2,    -1,
+        # ]
+        [[[True, False, False, False]]],
+    )
+
 class AttentionTest(absltest.TestCase):
 
   def _get_attn_output(
@@ -19,6 +19,7 @@ An example of a sampling class for a Gemma model.
 
 from collections.abc import Sequence
 import dataclasses
+import functools
 import warnings
 
 import chex
@@ -28,11 +29,26 @@ from gemma import transformer as transformer_lib
 from gemma.multimodal import vision as gemma_vision
 import jax
 import jax.numpy as jnp
+import numpy as np
 
 import sentencepiece as spm
 
 _compute_attention_masks = transformer_lib.compute_attention_masks
 
+# Buffer lengths are rounded up to one of those sizes, so prompts of different
+# lengths share the same compiled sampling function.
+_BUCKETS = (128, 256, 512, 1024, 2048)
+
+
+def _bucket_length(length: int) -> int:
+  """Rounds the length up to the next bucket (unchanged if above all)."""
+  return next((b for b in _BUCKETS if b >= length), length)
+
+
+def _bucket_batch_size(batch_size: int) -> int:
+  """Rounds the batch size up to the next power of two."""
+  return 1 << (batch_size - 1).bit_length()
+
 
 @chex.dataclass
 class _SamplingState:
@@ -50,20 +66,26 @@ class _SamplingState:
   # Position indices, based on ignoring pad tokens.
   positions: jnp.ndarray  # [B, L]
 
+  # Which tokens of the token buffer are not padding. Computed once from the
+  # prompts, then updated with each generated token.
+  input_mask: jnp.ndarray  # [B, L]
+
   # Model state for conditioning the model on autoregressively.
   cache: dict[str, modules.LayerCache]
 
   # Is decoding done on the given sequence?
   done: jnp.ndarray  # [B]
 
-  # Total sampling steps (including the prompt).
-  total_sampling_steps: int
+  # Total sampling steps (including the prompt). Kept as an array, so a single
+  # compiled sampling function serves any length up to the buffer size.
+  total_sampling_steps: jnp.ndarray  # []
 
-  # Fixed-size buffer for accumulating the output logits.
-  logits_buffer: jnp.ndarray | None = None  # [B, L, V]
+  # Fixed-size buffer for accumulating the output logits. Empty (`L == 0`)
+  # when logits are not returned.
+  logits_buffer: jnp.ndarray  # [B, L, V]
 
-  # List of tokens that are forbidden to be generated.
-  forbidden_token_ids: Sequence[int] | None = None
+  # Mask of the tokens that are forbidden to be generated.
+  forbidden_mask: jnp.ndarray | None = None  # [V]
 
 
 @dataclasses.dataclass
@@ -72,11 +94,84 @@ class SamplerOutput:
   # Decoded samples from the model.
   text: list[str]
 
-  # Per-step logits used during sampling.
-  logits: list[list[float]]
-
-  # Tokens corresponding to the generated samples.
-  tokens: list[list[int]]
+  # Token buffer of the samples. Only the positions where `mask` is `True` are
+  # part of the samples.
+  tokens_array: np.ndarray  # [B, L]
+
+  # Mask of the returned positions of each sample.
+  mask: np.ndarray  # [B, L]
+
+  # Per-step logits used during sampling, or None if not returned.
+  logits_array: np.ndarray | None = None  # [B, L, V]
+
+  @functools.cached_property
+  def tokens(self) -> list[list[int]]:
+    """Tokens corresponding to the generated samples."""
+    return [row[m].tolist() for row, m in zip(self.tokens_array, self.mask)]
+
+  @functools.cached_property
+  def logits(self) -> list[list[list[float]]]:
+    """Per-step logits used during sampling."""
+    if self.logits_array is None:
+      return []
+    return [
+        row[m].astype(np.float32).tolist()
+        for row, m in zip(self.logits_array, self.mask)
+    ]
+
+
+@functools.partial(jax.jit, static_argnames=('echo',))
+def _finalize(
+    token_buffer: jnp.ndarray,  # [B, L]
+    logits_buffer: jnp.ndarray | None,  # [B, L, V]
+    num_input_tokens: jnp.ndarray,  # [B]
+    echo: bool,
+    total_sampling_steps: jnp.ndarray,
+) -> tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray | None]:
+  """Computes which buffer positions are returned, on device.
+
+  Args:
+    token_buffer: Token buffer, with tokens after EOS already masked.
+    logits_buffer: Logits buffer, or None if logits are not returned.
+    num_input_tokens: Number of prompt tokens for each sequence.
+    echo: Whether the prompt is returned as part of the output.
+    total_sampling_steps: Total sampling steps (including the prompt).
+
+  Returns:
+    The tokens `[B, L]`, a validity mask `[B, L]` which is `True` for the
+    positions to return for each sequence, and the logits `[B, L, V]` (or None).
+  """
+  if echo:
+    start_idx = jnp.zeros_like(num_input_tokens)
+  else:
+    start_idx = num_input_tokens
+  steps = jnp.arange(token_buffer.shape[1])[None, :]
+  mask = (steps >= start_idx[:, None]) & (steps < total_sampling_steps)
+  return token_buffer, mask, logits_buffer
+
+
+def _check_window_len(
+    config: transformer_lib.TransformerConfig,
+    window_len: int,
+    cache_length: int,
+) -> None:
+  """Checks that a `window_len` ring buffer cache is exact for the model."""
+  if modules.AttentionType.LOCAL_SLIDING not in config.attention_types:
+    raise ValueError(
+        'Sampler `window_len` requires layers using'
+        f' {modules.AttentionType.LOCAL_SLIDING}. Got:'
+        f' {config.attention_types}'
+    )
+  if config.sliding_window_size > window_len:
+    raise ValueError(
+        f'Sampler `window_len` ({window_len}) should be at least the model'
+        f' `sliding_window_size` ({config.sliding_window_size}).'
+    )
+  if window_len > cache_length:
+    raise ValueError(
+        f'Sampler `window_len` ({window_len}) should be at most the'
+        f' `cache_length` ({cache_length}).'
+    )
 
 
 class Sampler:
@@ -89,6 +184,8 @@ class Sampler:
       params: params_lib.Params,
       *,
       cache_length: int | None = None,
+      window_len: int | None = None,
+      logits_dtype: jnp.dtype = jnp.bfloat16,
   ):
     """Initializes a sampler for a Gemma model.
 
@@ -97,6 +194,13 @@ class Sampler:
       vocab: vocabulary of the given model.
       params: weights of the model.
       cache_length: Max length of the cache.
+      window_len: If set, the cache of the layers using sliding window
+        attention is a ring buffer of `window_len` tokens (instead of
+        `cache_length`), so these layers only attend over the window. Should
+        be at least the model `sliding_window_size`. The other layers keep a
+        cache of `cache_length` tokens. Prompts are pre-filled in chunks of
+        `window_len - sliding_window_size + 1` tokens.
+      logits_dtype: dtype of the logits buffer, when logits are returned.
     """
     msg = (
         "The old sampler is deprecated, behave unexpectedly and doesn't "
@@ -108,8 +212,16 @@ class Sampler:
 
     self.transformer = transformer
     self.vocab = vocab
+    # Cache the special token ids, to avoid calling the vocab each time.
+    self._pad_id = int(vocab.pad_id())
+    self._eos_id = int(vocab.eos_id())
+    self._bos_id = int(vocab.bos_id())
     self.params = params
-    self._compiled_sample_fn = jax.jit(self._sample_fn)
+    self.logits_dtype = logits_dtype
+    # Compiled sampling functions, keyed by (batch_size, buffer_size) bucket.
+    self._compiled_sample_fns = {}
+    # Compiled pre-filling functions, keyed by (batch_size, prompt_length).
+    self._compiled_prefill_fns = {}
     if cache_length is None:
       warnings.warn(
           'TransformerConfig.max_cache_length is deprecated and will be'
@@ -121,22 +233,184 @@ class Sampler:
     self.cache_length = cache_length or transformer.config.max_cache_length
     if self.cache_length is None:
       raise ValueError('Sampler `cache_length` should be set.')
+    if window_len is not None:
+      _check_window_len(transformer.config, window_len, self.cache_length)
+    self.window_len = window_len
 
   @property
   def dtype(self) -> jnp.dtype:
     return jax.tree_util.tree_leaves(self.params)[0].dtype
 
+  def _compiled_sample_fn(
+      self,
+      params: params_lib.Params,
+      initial_sampling_state: _SamplingState,
+  ) -> _SamplingState:
+    """Runs the sampling loop with the function compiled for this shape."""
+    key = initial_sampling_state.token_buffer.shape
+    if key not in self._compiled_sample_fns:
+      # The whole initial state is donated, so its buffers (most importantly
+      # the cache, token and logits buffers) are re-used in place rather than
+      # copied.
+      self._compiled_sample_fns[key] = jax.jit(
+          self._sample_fn,
+          donate_argnums=(1,),
+          static_argnames=('include_logits',),
+      )
+    return self._compiled_sample_fns[key](
+        params,
+        initial_sampling_state,
+        include_logits=initial_sampling_state.logits_buffer.shape[1] > 0,
+    )
+
+  def _prefill_fn(
+      self,
+      params: params_lib.Params,
+      tokens: jax.Array,
+      positions: jax.Array,
+      cache: transformer_lib.Cache,
+      attention_mask: jax.Array,
+      mm_data: jax.Array | None,
+      num_tokens: jax.Array,
+  ) -> tuple[jax.Array, transformer_lib.Cache]:
+    """Internal pre-filling function (to be jitted)."""
+    logits, cache = self.transformer.apply(
+        {'params': params},
+        tokens,
+        positions,
+        cache,
+        attention_mask,
+        mm_data,
+    )
+    # Tokens after the first `num_tokens` only pad the prompts to a static
+    # length. Decoding resumes after the prompts, overwriting them in the cache.
+    cache = {
+        layer_name: {
+            **layer_cache,
+            'end_index': jnp.full_like(layer_cache['end_index'], num_tokens),
+        }
+        for layer_name, layer_cache in cache.items()
+    }
+    return logits, cache
+
+  def _compiled_prefill_fn(
+      self,
+      params: params_lib.Params,
+      tokens: jax.Array,
+      positions: jax.Array,
+      cache: transformer_lib.Cache,
+      attention_mask: jax.Array,
+      mm_data: jax.Array | None,
+      num_tokens: jax.Array,
+  ) -> tuple[jax.Array, transformer_lib.Cache]:
+    """Runs the pre-filling with the function compiled for this shape."""
+    if mm_data is not None:
+      # The vision tokens checks of the transformer are not jit-compatible.
+      return self._prefill_fn(
+          params, tokens, positions, cache, attention_mask, mm_data, num_tokens
+      )
+    key = tokens.shape
+    if key not in self._compiled_prefill_fns:
+      # The freshly initialized cache is donated and filled in place.
+      self._compiled_prefill_fns[key] = jax.jit(
+          self._prefill_fn, donate_argnums=(3,)
+      )
+    return self._compiled_prefill_fns[key](
+        params, tokens, positions, cache, attention_mask, mm_data, num_tokens
+    )
+
+  def _chunked_prefill_fn(
+      self,
+      tokens: jax.Array,
+      positions: jax.Array,
+      input_mask: jax.Array,
+      num_tokens: int,
+  ) -> tuple[jax.Array, transformer_lib.Cache]:
+    """Pre-fills the prompts in chunks fitting in the `window_len` caches.
+
+    Each chunk only overwrites the ring buffer slots of the tokens which are
+    out of the sliding window of all the chunk tokens, so the result is exact.
+    All chunks have the same (bucketed) length, so share a compiled function:
+    the last chunk ends with the prompts, overlapping the previous one.
+
+    Args:
+      tokens: Token buffer, holding the prompts.
+      positions: Positions of the tokens.
+      input_mask: Padding mask of the tokens.
+      num_tokens: Number of prompt tokens to pre-fill.
+
+    Returns:
+      The logits of the prompt tokens `[B, num_tokens, V]` and the cache.
+    """
+    chunk_length = min(
+        self.window_len - self.transformer.config.sliding_window_size + 1,
+        _bucket_length(num_tokens),
+        tokens.shape[1],
+    )
+    chunk_starts = list(range(0, num_tokens - chunk_length, chunk_length))
+    chunk_starts.append(max(num_tokens - chunk_length, 0))
+    # Padding mask of the `cache_length` cache (the prompts fit in it).
+    cache_mask = jnp.take(
+        input_mask,
+        jnp.arange(self.cache_length),
+        axis=1,
+        mode='fill',
+        fill_value=False,
+    )
+    cache_slots = np.arange(self.cache_length)
+    cache = self.init_cache(tokens.shape[0])
+    all_logits = []
+    num_cached_tokens = 0
+    for start in chunk_starts:
+      end = start + chunk_length
+      if start < num_cached_tokens:
+        # The overlapping tokens are written again, to the same slots.
+        cache = {
+            layer_name: {
+                **layer_cache,
+                'end_index': jnp.full_like(layer_cache['end_index'], start),
+            }
+            for layer_name, layer_cache in cache.items()
+        }
+      causal_mask = cache_slots[None, :] <= np.arange(start, end)[:, None]
+      logits, cache = self._compiled_prefill_fn(
+          self.params,
+          tokens[:, start:end],
+          positions[:, start:end],
+          cache,
+          causal_mask[None] & cache_mask[:, None, :],
+          None,
+          min(end, num_tokens),
+      )
+      # Only keep the logits of the new prompt tokens.
+      all_logits.append(
+          logits[:, num_cached_tokens - start : min(end, num_tokens) - start]
+      )
+      num_cached_tokens = end
+    return jnp.concatenate(all_logits, axis=1), cache
+
   def _sample_step(
-      self, params, sampler_state: _SamplingState
+      self, params, sampler_state: _SamplingState, include_logits: bool
   ) -> _SamplingState:
     """Performs a single sampling step."""
     batch_size = sampler_state.token_buffer.shape[0]
-    input_mask = sampler_state.token_buffer != self.vocab.pad_id()
     decoding_step = jnp.asarray(sampler_state.decoding_step, dtype=jnp.int32)
     last_token = sampler_state.token_buffer[:, decoding_step]
-    attention_mask = transformer_lib.compute_attention_masks(
-        decoding_step, self.cache_length, input_mask
+    # Buffer index of the token held by each cache slot (the cache is a ring
+    # buffer). Slots which are not yet written, and padding tokens (including
+    # generated ones), are masked.
+    cache_slots = jnp.arange(self.cache_length)
+    slot_index = decoding_step - (decoding_step - cache_slots) % (
+        self.cache_length
+    )
+    slot_mask = jnp.take(
+        sampler_state.input_mask,
+        jnp.maximum(slot_index, 0),
+        axis=1,
+        mode='clip',
     )
+    attention_mask = (slot_index >= 0) & slot_mask
+    attention_mask = attention_mask[:, jnp.newaxis, :]
     step_positions = jnp.expand_dims(
         sampler_state.positions[:, decoding_step], -1
     )
@@ -148,14 +422,16 @@ class Sampler:
         sampler_state.cache,
         attention_mask,
     )
-    if sampler_state.forbidden_token_ids:
-      logits = logits.at[:, :, sampler_state.forbidden_token_ids].set(-jnp.inf)
+    if sampler_state.forbidden_mask is not None:
+      logits = jnp.where(sampler_state.forbidden_mask, -jnp.inf, logits)
 
     next_token_candidate = jnp.argmax(logits, axis=-1)  # [B, 1]
     next_token_candidate = next_token_candidate[:, 0]  # [B,]
 
+    # Keep the prompt tokens, and freeze the sequences which are done.
     next_token_candidate = jnp.where(
-        decoding_step < sampler_state.num_input_tokens - 1,
+        (decoding_step < sampler_state.num_input_tokens - 1)
+        | sampler_state.done,
         sampler_state.token_buffer[:, decoding_step + 1],
         next_token_candidate,
     )
@@ -163,17 +439,23 @@ class Sampler:
     token_buffer = sampler_state.token_buffer.at[:, decoding_step + 1].set(
         next_token_candidate
     )
+    # Only the column of the new token changes.
+    input_mask = jax.lax.dynamic_update_slice(
+        sampler_state.input_mask,
+        (next_token_candidate != self._pad_id)[:, None],
+        (0, decoding_step + 1),
+    )
 
-    if sampler_state.logits_buffer is not None:
+    if include_logits:
       next_logits = jnp.squeeze(logits, 1)
       logits_buffer = sampler_state.logits_buffer.at[:, decoding_step + 1].set(
-          next_logits
+          next_logits.astype(sampler_state.logits_buffer.dtype)
       )
     else:
       logits_buffer = sampler_state.logits_buffer
 
     done = sampler_state.done | jnp.equal(
-        token_buffer[:, decoding_step + 1], self.vocab.eos_id()
+        token_buffer[:, decoding_step + 1], self._eos_id
     )
 
     return _SamplingState(
@@ -181,11 +463,12 @@ class Sampler:
         num_input_tokens=sampler_state.num_input_tokens,
         token_buffer=token_buffer,
         positions=sampler_state.positions,
+        input_mask=input_mask,
         logits_buffer=logits_buffer,
         cache=cache,
         done=done,
         total_sampling_steps=sampler_state.total_sampling_steps,
-        forbidden_token_ids=sampler_state.forbidden_token_ids,
+        forbidden_mask=sampler_state.forbidden_mask,
     )
 
   def init_cache(self, bsz) -> dict[str, modules.LayerCache]:
@@ -194,37 +477,57 @@ class Sampler:
         bsz,
         dtype=self.dtype,
         cache_length=self.cache_length,
+        window_length=self.window_len,
     )
 
   def init_sample_state(
       self,
-      all_input_ids: list[jax.Array],
+      all_input_ids: list[Sequence[int] | jax.Array],
       total_sampling_steps: int,
       patched_images: jax.Array | None,
       include_logits: bool = False,
-      forbidden_token_ids: Sequence[int] | None = None,
+      forbidden_mask: jax.Array | None = None,
+      buffer_size: int | None = None,
+      num_prompts: int | None = None,
   ) -> _SamplingState:
-    """Initializes the sampling state given input prompts."""
-    bsz = len(all_input_ids)
-    num_input_tokens = [len(input_ids) for input_ids in all_input_ids]
-    buffer_size = total_sampling_steps + 1
-
-    token_buffer = jnp.full(
-        (bsz, buffer_size), self.vocab.pad_id(), dtype=jnp.int32
-    )
-    input_mask = jnp.ones_like(token_buffer, dtype=jnp.bool_)
-    for i, (input_ids, num_tokens) in enumerate(
-        zip(all_input_ids, num_input_tokens)
-    ):
-      token_buffer = token_buffer.at[i, :num_tokens].set(input_ids)
-      input_mask = input_mask.at[i, :num_tokens].set(
-          input_ids != self.vocab.pad_id()
-      )
+    """Initializes the sampling state given input prompts.
 
-    positions = transformer_lib.build_positions_from_mask(input_mask)
+    Args:
+      all_input_ids: Token ids of the prompts.
+      total_sampling_steps: Total sampling steps (including the prompt).
+      patched_images: Patched images, or None.
+      include_logits: Whether the logits are returned.
+      forbidden_mask: Mask of the tokens forbidden to be generated, or None.
+      buffer_size: Length of the token buffer (by default, just enough for
+        `total_sampling_steps`).
+      num_prompts: Number of actual prompts. The following rows of
+        `all_input_ids` only pad the batch, and are done from the start.
 
-    done = jnp.zeros((bsz,), dtype=jnp.bool_)
-    num_input_tokens = jnp.array(num_input_tokens, dtype=jnp.int32)
+    Returns:
+      The initial sampling state.
+    """
+    bsz = len(all_input_ids)
+    num_input_tokens = np.array(
+        [len(input_ids) for input_ids in all_input_ids], dtype=np.int32
+    )
+    buffer_size = buffer_size or total_sampling_steps + 1
+
+    # Pack the prompts on host, so a single array is sent to the device.
+    token_buffer = np.full((bsz, buffer_size), self._pad_id, np.int32)
+    for i, input_ids in enumerate(all_input_ids):
+      input_ids = np.asarray(input_ids)
+      token_buffer[i, : len(input_ids)] = input_ids
+    token_buffer = jnp.asarray(token_buffer)
+    num_input_tokens = jnp.asarray(num_input_tokens)
+    padding_mask = token_buffer != self._pad_id
+
+    # Padding inside the prompts is skipped, positions after them are not.
+    positions = transformer_lib.build_positions_from_mask(
+        padding_mask
+        | (jnp.arange(buffer_size)[None, :] >= num_input_tokens[:, None])
+    )
+
+    done = jnp.arange(bsz) >= (bsz if num_prompts is None else num_prompts)
     # Pre-process prompt and images.
     vision_embeddings = gemma_vision.initialize_vision_tokens(
         patched_images, token_buffer, num_input_tokens
@@ -236,107 +539,180 @@ class Sampler:
       positions = jnp.tile(
           jnp.arange(token_buffer.shape[1]).reshape(1, -1), (bsz, 1)
       )
+      # The vision tokens were inserted in the buffer.
+      padding_mask = token_buffer != self._pad_id
 
-    input_mask = token_buffer != self.vocab.pad_id()
     decoding_step = num_input_tokens[0]
     bi_directional_mask = token_buffer == gemma_vision.TOKEN_PLACEHOLDER
-    logits, cache = self.transformer.apply(
-        {'params': self.params},
-        jax.lax.dynamic_slice(token_buffer, (0, 0), (bsz, decoding_step)),
-        positions[:, :decoding_step],
-        self.init_cache(bsz),
-        transformer_lib.compute_sequence_attention_mask(
-            time_step=decoding_step,
-            seq_len=self.cache_length,
-            input_mask=input_mask,
-            bi_directional_mask=bi_directional_mask,
-        ),
-        mm_data,
-    )
+    if decoding_step > self.cache_length:
+      raise ValueError(
+          f'Prompts ({int(decoding_step)} tokens) should fit in the cache'
+          f' ({self.cache_length} tokens).'
+      )
+    if self.window_len is not None:
+      if mm_data is not None:
+        raise ValueError('Sampler `window_len` does not support images.')
+      logits, cache = self._chunked_prefill_fn(
+          token_buffer, positions, padding_mask, int(decoding_step)
+      )
+    else:
+      if mm_data is None:
+        # Pad the prompts to a bucketed length, so prompts of different
+        # lengths share the same compiled pre-filling. The causal mask ensures
+        # that the prompt tokens never attend to the padding.
+        prefill_length = min(
+            _bucket_length(int(decoding_step)),
+            self.cache_length,
+            token_buffer.shape[1],
+        )
+      else:
+        prefill_length = int(decoding_step)
+      logits, cache = self._compiled_prefill_fn(
+          self.params,
+          token_buffer[:, :prefill_length],
+          positions[:, :prefill_length],
+          self.init_cache(bsz),
+          transformer_lib.compute_sequence_attention_mask(
+              time_step=prefill_length,
+              seq_len=self.cache_length,
+              input_mask=padding_mask,
+              bi_directional_mask=bi_directional_mask,
+          ),
+          mm_data,
+          decoding_step,
+      )
+    logits = logits[:, :decoding_step]
     if include_logits:
-      logits_buffer = jnp.concatenate(
-          [
-              jnp.zeros(
-                  (bsz, 1, self.transformer.config.num_embed),
-                  dtype=jnp.float32,
-              ),
-              logits,
-              jnp.zeros(
-                  (
-                      bsz,
-                      buffer_size - decoding_step - 1,
-                      self.transformer.config.num_embed,
-                  ),
-                  dtype=jnp.float32,
-              ),
-          ],
-          axis=1,
+      logits_buffer = jnp.zeros(
+          (bsz, buffer_size, self.transformer.config.num_embed),
+          dtype=self.logits_dtype,
+      )
+      logits_buffer = jax.lax.dynamic_update_slice(
+          logits_buffer, logits.astype(self.logits_dtype), (0, 1, 0)
       )
     else:
-      logits_buffer = None
+      logits_buffer = jnp.zeros(
+          (bsz, 0, self.transformer.config.num_embed), dtype=self.logits_dtype
+      )
 
     # We decoded one token here:
-    if forbidden_token_ids:
-      logits = logits.at[:, :, forbidden_token_ids].set(-jnp.inf)
+    if forbidden_mask is not None:
+      logits = jnp.where(forbidden_mask, -jnp.inf, logits)
     next_token_candidate = jnp.argmax(logits, axis=-1)
     next_token_candidate = next_token_candidate[:, -1]
     token_buffer = token_buffer.at[:, decoding_step].set(next_token_candidate)
+    input_mask = jax.lax.dynamic_update_slice(
+        padding_mask,
+        (next_token_candidate != self._pad_id)[:, None],
+        (0, decoding_step),
+    )
 
     return _SamplingState(
         decoding_step=decoding_step,
         num_input_tokens=num_input_tokens,
         token_buffer=token_buffer,
         positions=positions,
+        input_mask=input_mask,
         logits_buffer=logits_buffer,
         cache=cache,
         done=done,
-        total_sampling_steps=total_sampling_steps,
-        forbidden_token_ids=forbidden_token_ids,
+        total_sampling_steps=jnp.asarray(total_sampling_steps, jnp.int32),
+        forbidden_mask=forbidden_mask,
     )
 
   def tokenize(self, input_string: str) -> jax.Array:
     """Tokenizes the input string."""
     input_ids = self.vocab.EncodeAsIds(input_string)
-    input_ids = jnp.array(
-        [self.vocab.bos_id()] + jnp.array(input_ids).tolist(), dtype=jnp.int32
-    )
-    return input_ids
+    # Prepend the BOS token on host, then transfer once.
+    tokens = np.empty((len(input_ids) + 1,), dtype=np.int32)
+    tokens[0] = self._bos_id
+    tokens[1:] = input_ids
+    return jnp.asarray(tokens)
+
+  def tokenize_batch(self, input_strings: Sequence[str]) -> list[list[int]]:
+    """Tokenizes the input strings with a single (batched) vocab call."""
+    all_input_ids = self.vocab.EncodeAsIds(list(input_strings))
+    return [[self._bos_id] + input_ids for input_ids in all_input_ids]
 
   def mask_tokens_after_eos_ids(self, token_buffer):
     """Mask token IDs after the EOS token with the padding ID."""
-    eos_id = self.vocab.eos_id()
-    eos_exists = jnp.any(jnp.equal(token_buffer, eos_id), axis=-1)
-    eos_indices = jnp.where(
-        eos_exists,
-        jnp.argmax(jnp.equal(token_buffer, eos_id), axis=-1),
-        token_buffer.shape[-1],
-    )
-    mask = jnp.less_equal(
-        jnp.arange(token_buffer.shape[-1]), eos_indices[:, None]
-    )
-    masked_token_buffer = token_buffer * mask + self.vocab.pad_id() * (1 - mask)
-
-    return masked_token_buffer
+    is_eos = token_buffer == self._eos_id
+    # Number of EOS tokens strictly before each position.
+    num_eos_before = jnp.cumsum(is_eos, axis=-1) - is_eos
+    return jnp.where(num_eos_before == 0, token_buffer, self._pad_id)
 
   def _sample_fn(
       self,
       params: params_lib.Params,
       initial_sampling_state: _SamplingState,
+      include_logits: bool,
   ) -> _SamplingState:
     """Internal sampling function (to be jitted)."""
 
     def sample_with_params(sampler_state: _SamplingState):
-      return self._sample_step(params, sampler_state)
+      return self._sample_step(params, sampler_state, include_logits)
 
     def cond_fn(sampler_state: _SamplingState):
       return (
           sampler_state.decoding_step < sampler_state.total_sampling_steps
       ) & jnp.any(jnp.logical_not(sampler_state.done))
 
+    # The number of steps is only known at run time (`total_sampling_steps` is
+    # an array, so a single compiled function serves any length), hence a
+    # `while_loop`, which also exits as soon as all sequences are done.
     return jax.lax.while_loop(
         cond_fn, sample_with_params, initial_sampling_state
     )
 
+  def warm_up(
+      self,
+      batch_size: int,
+      prompt_length: int,
+      total_generation_steps: int,
+      return_logits: bool = True,
+  ) -> None:
+    """Compiles the sampling functions for the given shapes.
+
+    This moves the compilation of the pre-filling, sampling and finalizing
+    functions out of the first `__call__` with matching shapes (e.g. to call
+    right after creating the sampler), with the default `echo=False`. Calls
+    with `forbidden_tokens` use a different sampling state pytree (the
+    `forbidden_mask` is not None), so still compile on first use.
+
+    Args:
+      batch_size: number of prompts.
+      prompt_length: number of tokens of the prompts (including BOS).
+      total_generation_steps: number of generation steps.
+      return_logits: whether the logits will be returned.
+    """
+    all_input_ids = [[self._bos_id] * prompt_length] * (
+        _bucket_batch_size(batch_size)
+    )
+    total_sampling_steps = prompt_length + total_generation_steps
+    initial_sampling_state = self.init_sample_state(
+        all_input_ids,
+        include_logits=return_logits,
+        total_sampling_steps=total_sampling_steps,
+        patched_images=None,
+        buffer_size=_bucket_length(total_sampling_steps + 1),
+        num_prompts=batch_size,
+    )
+    # Without any step left, the sampling loop is compiled but never calls the
+    # model.
+    initial_sampling_state.total_sampling_steps = jnp.asarray(0, jnp.int32)
+    sampling_state = self._compiled_sample_fn(
+        self.params, initial_sampling_state
+    )
+    jax.block_until_ready(
+        _finalize(
+            self.mask_tokens_after_eos_ids(sampling_state.token_buffer),
+            sampling_state.logits_buffer if return_logits else None,
+            sampling_state.num_input_tokens,
+            echo=False,
+            total_sampling_steps=sampling_state.total_sampling_steps,
+        )
+    )
+
   def __call__(
       self,
       input_strings: Sequence[str],
@@ -361,28 +737,40 @@ class Sampler:
     Returns:
       sampler_output: A SamplerOutput object containing the generated samples.
     """
-    forbidden_token_ids = None
-    if forbidden_tokens is not None:
-      forbidden_token_ids = []
+    forbidden_mask = None
+    if forbidden_tokens:
+      forbidden_mask = np.zeros((self.transformer.config.num_embed,), np.bool_)
       for token in forbidden_tokens:
         token_id = self.vocab.EncodeAsIds(token)
         if len(token_id) != 1:
           raise ValueError(
               'Forbidden tokens must map to single token ids in the vocab.'
           )
-        forbidden_token_ids.extend(token_id)
-      forbidden_token_ids = tuple(forbidden_token_ids)
-    all_input_ids = [self.tokenize(x) for x in input_strings]
+        forbidden_mask[token_id] = True
+      forbidden_mask = jnp.asarray(forbidden_mask)
+    all_input_ids = self.tokenize_batch(input_strings)
     mm_extra_len = transformer_lib.mm_input_length(patched_images)
     max_input_length = max(len(input_ids) for input_ids in all_input_ids)
     total_sampling_steps = max_input_length + total_generation_steps
     total_sampling_steps += mm_extra_len
+
+    # Pad the buffer length and the batch size to fixed buckets to avoid
+    # re-compiling the sampling function for each new shape.
+    num_prompts = len(all_input_ids)
+    if patched_images is None:
+      dummy_input_ids = np.array([self._bos_id], dtype=np.int32)
+      all_input_ids += [dummy_input_ids] * (
+          _bucket_batch_size(num_prompts) - num_prompts
+      )
     initial_sampling_state = self.init_sample_state(
         all_input_ids,
         include_logits=return_logits,
         total_sampling_steps=total_sampling_steps,
-        forbidden_token_ids=forbidden_token_ids,
+        forbidden_mask=forbidden_mask,
         patched_images=patched_images,
+        buffer_size=_bucket_length(total_sampling_steps + 1),
+        # Dummy rows are done from the start, so they don't extend the loop.
+        num_prompts=num_prompts,
     )
 
     sampling_state = self._compiled_sample_fn(
@@ -393,25 +781,27 @@ class Sampler:
         sampling_state.token_buffer
     )
 
-    out_tokens = []
-    out_logits = []
-    for i, (token_buffer, num_tokens) in enumerate(
-        zip(
-            masked_token_buffer,
-            sampling_state.num_input_tokens,
-        )
-    ):
-      start_idx = 0 if echo else num_tokens
-      out_tokens.append(token_buffer[start_idx:total_sampling_steps].tolist())
-      if return_logits:
-        logits_buffer = sampling_state.logits_buffer[i]
-        out_logits.append(
-            logits_buffer[start_idx:total_sampling_steps].tolist()
-        )
-    decoded_outputs = [self.vocab.DecodeIds(tokens) for tokens in out_tokens]
+    tokens, mask, logits = _finalize(
+        masked_token_buffer,
+        sampling_state.logits_buffer if return_logits else None,
+        sampling_state.num_input_tokens,
+        echo=echo,
+        total_sampling_steps=sampling_state.total_sampling_steps,
+    )
+    # Drop the dummy rows and the buffer padding (never returned) on device,
+    # so only the returned part of the buffers is transferred to host.
+    tokens = np.asarray(tokens[:num_prompts, :total_sampling_steps])
+    mask = np.asarray(mask[:num_prompts, :total_sampling_steps])
+    decoded_outputs = [
+        self.vocab.DecodeIds(row[m].tolist()) for row, m in zip(tokens, mask)
+    ]
+    if return_logits:
+      logits = np.asarray(logits[:num_prompts, :total_sampling_steps])
+    # The `tokens` and `logits` lists are only built when accessed.
     result = SamplerOutput(
         text=decoded_outputs,
-        logits=out_logits,
-        tokens=out_tokens,
+        tokens_array=tokens,
+        mask=mask,
+        logits_array=logits,
     )
     return result
@@ -14,6 +14,7 @@
 
 """Minimal test for sampler."""
 
+import dataclasses
 from typing import Iterable
 
 from absl.testing import absltest
@@ -66,7 +67,11 @@ class MockVocab(spm.SentencePieceProcessor):
     reverse_mapping = {v: k for k, v in self._mapping_text_to_id.items()}
     return ' '.join(reverse_mapping[e] for e in ids)
 
-  def EncodeAsIds(self, text: str) -> list[int]:  # pylint: disable=invalid-name
+  def EncodeAsIds(  # pylint: disable=invalid-name
+      self, text: str | list[str]
+  ) -> list[int] | list[list[int]]:
+    if isinstance(text, list):
+      return [self.EncodeAsIds(t) for t in text]
     words = text.split(' ')
     return [self._mapping_text_to_id[word] for word in words]
 
@@ -172,6 +177,141 @@ class SamplerTest(absltest.TestCase):
       self.assertNotIn('string', output)
       self.assertNotIn('world', output)
 
+  def test_no_recompilation_across_lengths(self):
+    vocab = MockVocab()
+    transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
+        num_layers=1,
+        num_embed=vocab.GetPieceSize(),
+        embed_dim=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_kv_heads=1,
+        head_dim=64,
+        max_cache_length=32,
+        final_logit_softcap=None,
+        attention_types=[modules.AttentionType.GLOBAL],
+        use_post_attn_norm=None,
+        use_post_ffw_norm=None,
+    )
+    attention_mask = jnp.ones((1, 1, transformer_config.max_cache_length))
+    cache = transformer_config.init_cache(1, dtype=jnp.float32)
+    transformer = transformer_lib.Transformer(transformer_config)
+    params = transformer.init(
+        jax.random.PRNGKey(0),
+        jnp.array([[1]]),
+        jnp.array([[1]]),
+        cache,
+        attention_mask,
+    )
+    sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params=params['params'],
+        cache_length=transformer_config.max_cache_length,
+    )
+
+    sampler(['hello world'], total_generation_steps=5, return_logits=False)
+    sampler(['My name is'], total_generation_steps=10, return_logits=False)
+
+    # Both calls fall in the same buckets, so share a single executable.
+    (sample_fn,) = sampler._compiled_sample_fns.values()
+    self.assertEqual(sample_fn._cache_size(), 1)
+    (prefill_fn,) = sampler._compiled_prefill_fns.values()
+    self.assertEqual(prefill_fn._cache_size(), 1)
+
+  def test_batch_padding(self):
+    vocab = MockVocab()
+    transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
+        num_layers=1,
+        num_embed=vocab.GetPieceSize(),
+        embed_dim=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_kv_heads=1,
+        head_dim=64,
+        max_cache_length=32,
+        final_logit_softcap=None,
+        attention_types=[modules.AttentionType.GLOBAL],
+        use_post_attn_norm=None,
+        use_post_ffw_norm=None,
+    )
+    attention_mask = jnp.ones((1, 1, transformer_config.max_cache_length))
+    cache = transformer_config.init_cache(1, dtype=jnp.float32)
+    transformer = transformer_lib.Transformer(transformer_config)
+    params = transformer.init(
+        jax.random.PRNGKey(0),
+        jnp.array([[1]]),
+        jnp.array([[1]]),
+        cache,
+        attention_mask,
+    )
+    sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params=params['params'],
+        cache_length=transformer_config.max_cache_length,
+    )
+
+    # The batch of 3 prompts is padded to 4 rows, which are not returned.
+    prompts = ['hello world', 'input string', 'Hello there']
+    result = sampler(prompts, total_generation_steps=5)
+    self.assertLen(result.text, 3)
+    self.assertEqual(result.tokens_array.shape, (3, 8))
+    self.assertEqual(result.logits_array.shape[:2], (3, 8))
+    for i, prompt in enumerate(prompts):
+      single_result = sampler([prompt], total_generation_steps=5)
+      self.assertEqual(result.tokens[i], single_result.tokens[0])
+      self.assertEqual(result.text[i], single_result.text[0])
+
+  def test_warm_up(self):
+    vocab = MockVocab()
+    transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
+        num_layers=1,
+        num_embed=vocab.GetPieceSize(),
+        embed_dim=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_kv_heads=1,
+        head_dim=64,
+        max_cache_length=32,
+        final_logit_softcap=None,
+        attention_types=[modules.AttentionType.GLOBAL],
+        use_post_attn_norm=None,
+        use_post_ffw_norm=None,
+    )
+    attention_mask = jnp.ones((1, 1, transformer_config.max_cache_length))
+    cache = transformer_config.init_cache(1, dtype=jnp.float32)
+    transformer = transformer_lib.Transformer(transformer_config)
+    params = transformer.init(
+        jax.random.PRNGKey(0),
+        jnp.array([[1]]),
+        jnp.array([[1]]),
+        cache,
+        attention_mask,
+    )
+    sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params=params['params'],
+        cache_length=transformer_config.max_cache_length,
+    )
+
+    sampler.warm_up(batch_size=2, prompt_length=3, total_generation_steps=10)
+    (sample_fn,) = sampler._compiled_sample_fns.values()
+    (prefill_fn,) = sampler._compiled_prefill_fns.values()
+    self.assertEqual(sample_fn._cache_size(), 1)
+    self.assertEqual(prefill_fn._cache_size(), 1)
+    finalize_cache_size = sampler_lib._finalize._cache_size()
+
+    # The actual call re-uses the warmed-up functions.
+    result = sampler(['hello world', 'input string'], total_generation_steps=10)
+    self.assertLen(result.tokens, 2)
+    self.assertEqual(sample_fn._cache_size(), 1)
+    self.assertEqual(prefill_fn._cache_size(), 1)
+    self.assertEqual(sampler_lib._finalize._cache_size(), finalize_cache_size)
+    self.assertLen(sampler._compiled_sample_fns, 1)
+    self.assertLen(sampler._compiled_prefill_fns, 1)
+
   def test_forward_equivalence(self):
     vocab = MockVocab()
     transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
@@ -235,6 +375,175 @@ class SamplerTest(absltest.TestCase):
 
     np.testing.assert_almost_equal(output_forward, out_logits, decimal=2)
 
+  def test_generated_padding_is_masked(self):
+    vocab = MockVocab()
+    transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
+        num_layers=2,
+        num_embed=vocab.GetPieceSize(),
+        embed_dim=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_kv_heads=1,
+        head_dim=64,
+        max_cache_length=32,
+        final_logit_softcap=None,
+        attention_types=[modules.AttentionType.GLOBAL],
+        use_post_attn_norm=None,
+        use_post_ffw_norm=None,
+    )
+    attention_mask = jnp.ones((1, 1, transformer_config.max_cache_length))
+    cache = transformer_config.init_cache(1, dtype=jnp.float32)
+    transformer = transformer_lib.Transformer(transformer_config)
+    params = transformer.init(
+        jax.random.PRNGKey(0),
+        jnp.array([[1]]),
+        jnp.array([[1]]),
+        cache,
+        attention_mask,
+    )
+    sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params=params['params'],
+        cache_length=transformer_config.max_cache_length,
+        logits_dtype=jnp.float32,
+    )
+
+    # Forbid all tokens but the padding, so only padding is generated.
+    forbidden_tokens = [
+        token for token in vocab._mapping_text_to_id if token != '<pad>'
+    ]
+    result = sampler(
+        ['My name is Morgane'],
+        total_generation_steps=6,
+        echo=True,
+        forbidden_tokens=forbidden_tokens,
+    )
+    tokens = jnp.asarray(result.tokens)
+    self.assertEqual(result.tokens[0][5:], [vocab.pad_id()] * 6)
+
+    # The generated padding is never attended to, as in a forward pass.
+    num_tokens = tokens.shape[1]
+    input_mask = jnp.zeros((1, transformer_config.max_cache_length), bool)
+    input_mask = input_mask.at[:, :num_tokens].set(tokens != vocab.pad_id())
+    attention_mask = transformer_lib.make_causal_attn_mask(input_mask)
+    output_forward, _ = transformer.apply(
+        params,
+        last_tokens=tokens,
+        positions=jnp.arange(num_tokens)[None, :],
+        cache=transformer_config.init_cache(1, dtype=jnp.float32),
+        attention_mask=attention_mask[:, :num_tokens],
+    )
+    # Other tokens are forbidden, so only the padding logits are compared.
+    np.testing.assert_allclose(
+        output_forward[0, :-1, vocab.pad_id()],
+        np.asarray(result.logits[0])[1:, vocab.pad_id()],
+        atol=1e-4,
+    )
+
+  def test_window_len(self):
+    vocab = MockVocab()
+    transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
+        num_layers=2,
+        num_embed=vocab.GetPieceSize(),
+        embed_dim=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_kv_heads=1,
+        head_dim=64,
+        max_cache_length=32,
+        final_logit_softcap=None,
+        attention_types=[
+            modules.AttentionType.LOCAL_SLIDING,
+            modules.AttentionType.GLOBAL,
+        ],
+        sliding_window_size=4,
+        use_post_attn_norm=None,
+        use_post_ffw_norm=None,
+    )
+    attention_mask = jnp.ones((1, 1, transformer_config.max_cache_length))
+    cache = transformer_config.init_cache(1, dtype=jnp.float32)
+    transformer = transformer_lib.Transformer(transformer_config)
+    params = transformer.init(
+        jax.random.PRNGKey(0),
+        jnp.array([[1]]),
+        jnp.array([[1]]),
+        cache,
+        attention_mask,
+    )
+    full_sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params=params['params'],
+        cache_length=transformer_config.max_cache_length,
+        logits_dtype=jnp.float32,
+    )
+    window_sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params=params['params'],
+        cache_length=transformer_config.max_cache_length,
+        window_len=6,
+        logits_dtype=jnp.float32,
+    )
+    # Only the sliding window layer cache is a ring buffer.
+    window_cache = window_sampler.init_cache(1)
+    self.assertEqual(window_cache['layer_0']['k'].shape[1], 6)
+    self.assertEqual(window_cache['layer_1']['k'].shape[1], 32)
+
+    # Generate past the window, so the ring buffer wraps around. The long
+    # prompt is pre-filled in (overlapping) chunks of 3 tokens.
+    long_prompt = 'My name is Morgane hello world input string'
+    for prompt in ['hello world', long_prompt]:
+      full_result = full_sampler(
+          [prompt], total_generation_steps=10, echo=True
+      )
+      window_result = window_sampler(
+          [prompt], total_generation_steps=10, echo=True
+      )
+      self.assertEqual(full_result.tokens, window_result.tokens)
+      np.testing.assert_allclose(
+          full_result.logits, window_result.logits, atol=1e-4
+      )
+    # All the chunks share the same compiled pre-filling.
+    self.assertLen(window_sampler._compiled_prefill_fns, 1)
+
+    with self.assertRaisesRegex(ValueError, 'should fit in the cache'):
+      window_sampler([' '.join(['hello'] * 40)], total_generation_steps=10)
+
+    with self.assertRaisesRegex(ValueError, 'sliding_window_size'):
+      sampler_lib.Sampler(
+          transformer=transformer,
+          vocab=vocab,
+          params=params['params'],
+          cache_length=transformer_config.max_cache_length,
+          window_len=2,
+      )
+
+    with self.assertRaisesRegex(ValueError, 'at most the `cache_length`'):
+      sampler_lib.Sampler(
+          transformer=transformer,
+          vocab=vocab,
+          params=params['params'],
+          cache_length=transformer_config.max_cache_length,
+          window_len=64,
+      )
+
+    global_transformer = transformer_lib.Transformer(
+        dataclasses.replace(
+            transformer_config,
+            attention_types=[modules.AttentionType.GLOBAL] * 2,
+        )
+    )
+    with self.assertRaisesRegex(ValueError, 'requires layers using'):
+      sampler_lib.Sampler(
+          transformer=global_transformer,
+          vocab=vocab,
+          params=params['params'],
+          cache_length=transformer_config.max_cache_length,
+          window_len=6,
+      )
+
   def test_sampler_init_sample_state(self):
     vocab = MockVocab()
     transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
@@ -280,6 +589,36 @@ class SamplerTest(absltest.TestCase):
     self.assertListEqual(list(sample_state.positions[0]), [0, 0, 1, 2, 3, 4])
     self.assertListEqual(list(sample_state.positions[1]), [0, 1, 2, 2, 3, 4])
 
+  def test_tokenize_batch(self):
+    vocab = MockVocab()
+    transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
+        num_layers=0,
+        num_embed=vocab.GetPieceSize(),
+        embed_dim=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_kv_heads=1,
+        head_dim=64,
+        max_cache_length=8,
+        final_logit_softcap=None,
+        attention_types=[modules.AttentionType.GLOBAL],
+        use_post_attn_norm=None,
+        use_post_ffw_norm=None,
+    )
+    transformer = transformer_lib.Transformer(transformer_config)
+    sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params={},
+        cache_length=transformer_config.max_cache_length,
+    )
+
+    input_strings = ['hello world', 'My name is Morgane']
+    self.assertListEqual(
+        sampler.tokenize_batch(input_strings),
+        [sampler.tokenize(x).tolist() for x in input_strings],
+    )
+
   def test_sampler_mask_tokens_after_eos_ids(self):
     vocab = MockVocab()
     transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
@@ -328,6 +667,54 @@ class SamplerTest(absltest.TestCase):
     self.assertListEqual(list(masked_token_buffer[0]), [1, 5, 6, 2, 0, 0])
     self.assertListEqual(list(masked_token_buffer[1]), [1, 3, 4, 2, 0, 0])
 
+  def test_sampling_state_buffers_are_donated(self):
+    vocab = MockVocab()
+    transformer_config = transformer_lib.TransformerConfig(  # pytype: disable=wrong-arg-types
+        num_layers=2,
+        num_embed=vocab.GetPieceSize(),
+        embed_dim=32,
+        hidden_dim=64,
+        num_heads=4,
+        num_kv_heads=1,
+        head_dim=64,
+        max_cache_length=8,
+        final_logit_softcap=None,
+        attention_types=[modules.AttentionType.GLOBAL],
+        use_post_attn_norm=None,
+        use_post_ffw_norm=None,
+    )
+    attention_mask = jnp.ones((1, 1, transformer_config.max_cache_length))
+    cache = transformer_config.init_cache(1, dtype=jnp.float32)
+    transformer = transformer_lib.Transformer(transformer_config)
+    params = transformer.init(
+        jax.random.PRNGKey(0),
+        jnp.array([[1]]),
+        jnp.array([[1]]),
+        cache,
+        attention_mask,
+    )
+    sampler = sampler_lib.Sampler(
+        transformer=transformer,
+        vocab=vocab,
+        params=params['params'],
+        cache_length=transformer_config.max_cache_length,
+    )
+
+    all_input_ids = [sampler.tokenize('hello world')]
+    sample_state = sampler.init_sample_state(
+        all_input_ids,
+        total_sampling_steps=5,
+        patched_images=None,
+    )
+    sampler._compiled_sample_fn(sampler.params, sample_state)
+
+    # The K and V cache of each layer, and the token buffer, are re-used in
+    # place by the sampling loop.
+    for layer_cache in sample_state.cache.values():
+      self.assertTrue(layer_cache['k'].is_deleted())
+      self.assertTrue(layer_cache['v'].is_deleted())
+    self.assertTrue(sample_state.token_buffer.is_deleted())
+
   def test_compute_attention_mask(self):
     # Check that the input mask is correctly applied when total sampling steps
     # is lower than the max cache length.
@@ -381,8 +381,20 @@ class TransformerConfig:
       dtype: jnp.dtype = jnp.bfloat16,
       *,
       cache_length: int | None = None,
+      window_length: int | None = None,
   ) -> Cache:
-    """Initializes a new Transformer cache."""
+    """Initializes a new Transformer cache.
+
+    Args:
+      batch_size: Batch size.
+      dtype: dtype of the cache.
+      cache_length: Length of the cache.
+      window_length: If set, the layers using sliding window attention only
+        keep a ring buffer of `window_length` tokens.
+
+    Returns:
+      The cache of each layer.
+    """
     cache_length = cache_length or self.max_cache_length
     if cache_length is None:
       raise ValueError(
@@ -390,13 +402,16 @@ class TransformerConfig:
       )
     cache = {
         f'layer_{i}': modules.Attention.init_cache(
-            cache_length,
+            window_length
+            if window_length is not None
+            and attn_type == modules.AttentionType.LOCAL_SLIDING
+            else cache_length,
             self.num_kv_heads,
             self.head_dim,
             batch_size,
             dtype,
         )
-        for i in range(self.num_layers)
+        for i, attn_type in zip(range(self.num_layers), self.attention_types)
     }
     return cache
 
@@ -259,6 +259,29 @@ class TransformerTest(parameterized.TestCase):
     self.assertEqual(cache['layer_0']['k'].shape, k_shape)
     self.assertEqual(cache['layer_0']['v'].shape, v_shape)
 
+  def test_creates_cache_with_window_length(self):
+    config = transformer_lib.TransformerConfig(
+        num_layers=2,
+        num_embed=0,  # unused
+        embed_dim=0,  # unused
+        hidden_dim=0,  # unused
+        num_heads=3,
+        head_dim=4,
+        num_kv_heads=3,
+        max_cache_length=8,
+        final_logit_softcap=None,
+        attention_types=[
+            modules.AttentionType.LOCAL_SLIDING,
+            modules.AttentionType.GLOBAL,
+        ],
+        sliding_window_size=2,
+        use_post_attn_norm=False,
+        use_post_ffw_norm=False,
+    )
+    cache = config.init_cache(1, window_length=4)
+    self.assertEqual(cache['layer_0']['k'].shape, (1, 4, 3, 4))
+    self.assertEqual(cache['layer_1']['k'].shape, (1, 8, 3, 4))
+
   @parameterized.parameters([
       dict(
           batch_size=1,